@@ -1,32 +1,157 @@
 import math
-import re
+import struct
 import gdb
+import gdb.printing
+from functools import lru_cache, partial, wraps
 from typing import Iterator
 
-def make_template_arguments_iterator(type: gdb.Type):
+TYPE_CACHE_SIZE = 1024
+
+class TypeKey(object):
 	"""  """
 
-	try:
-		idx = 0
-		while True:
-			yield type.template_argument(idx)
-			idx += 1
-	except RuntimeError:
-		pass
+	def __init__(self, type: gdb.Type) -> None:
+		"""  """
+
+		# Strip typedefs, local aliases may share the same name
+		self.type = type.strip_typedefs()
+		self.name = str(self.type)
+	
+	def __hash__(self) -> int:
+		"""  """
+
+		return hash(self.name)
+	
+	def __eq__(self, other) -> bool:
+		"""  """
+
+		return self.name == other.name
+
+def type_cache(func):
+	"""  """
+
+	cached = lru_cache(maxsize=TYPE_CACHE_SIZE)(lambda key: func(key.type))
+
+	@wraps(func)
+	def wrapper(type: gdb.Type):
+		"""  """
+
+		return cached(TypeKey(type))
+	
+	return wrapper
+
+@type_cache
+def get_array_type_size(type: gdb.Type):
+	"""  """
+
+	return type.sizeof // type.target().sizeof
 
 def array_size(array: gdb.Value):
 	"""  """
 
-	return array.type.sizeof // array[0].type.sizeof
+	if array.type.code == gdb.TYPE_CODE_ARRAY:
+		# Use element type, no need to read array
+		return get_array_type_size(array.type)
+	else:
+		return array.type.sizeof // array[0].type.sizeof
+
+def get_print_elements_hint():
+	"""  """
+
+	# Only a sizing hint, children must not be clamped
+	# to it: per-command overrides and MI varobjs are not
+	# visible here and may pull every child
+	limit = gdb.parameter('print elements')
+	if not limit: return None
+
+	# One more than the limit, GDB pulls
+	# it to decide whether to print '...'
+	return limit + 1
+
+def get_target_byte_order() -> str:
+	"""  """
+
+	# Looked up on every call, the
+	# target may change during a session
+	one = gdb.Value(1).cast(gdb.lookup_type('int'))
+	if hasattr(one, 'bytes'):
+		return '<' if one.bytes[0] == 1 else '>'
+
+	# Older GDBs, fall back to show endian
+	endian = gdb.execute('show endian', to_string=True)
+	if 'big endian' in endian:
+		return '>'
+	elif 'little endian' in endian:
+		return '<'
+	else:
+		# Unknown output, assume host byte order
+		return '='
+
+@type_cache
+def get_scalar_format(type: gdb.Type):
+	"""  """
+
+	type = type.unqualified()
+
+	# Get struct format of integer and floating point types
+	if type.code in (gdb.TYPE_CODE_INT, gdb.TYPE_CODE_CHAR):
+		scalar_format = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}.get(type.sizeof)
+		if scalar_format is not None and gdb.Value(-1).cast(type) > 0:
+			scalar_format = scalar_format.upper()
+
+		return scalar_format
+	elif type.code == gdb.TYPE_CODE_FLT:
+		return {4: 'f', 8: 'd'}.get(type.sizeof)
+	else:
+		return None
+
+@type_cache
+def get_tuple_layout(type: gdb.Type):
+	"""  """
+
+	# Walk base chain once, recording for each item the base
+	# field to step into, the item field itself and the item
+	# byte offset and pointer type
+	base_field = type.fields()[0]
+	base_offset = 0
+
+	layout = []
+	while base_field is not None:
+		base_offset += base_field.bitpos // 8
+
+		fields = base_field.type.fields()
+		item_field = fields[-1]
+		item_offset = base_offset + item_field.bitpos // 8
+		layout.append((base_field, item_field, item_offset, item_field.type.pointer()))
+
+		base_field = fields[0] if len(fields) == 2 else None
+
+	return layout
+
+@type_cache
+def is_string_type(type: gdb.Type):
+	"""  """
+
+	return type.template_argument(0).code == gdb.TYPE_CODE_CHAR
 
 def make_node_iterator(node_ptr: gdb.Value):
 	"""  """
 
+	node_type = node_ptr.type.target().strip_typedefs()
+	data_ptr_type = node_type['data'].type.pointer()
+	next_ptr_ptr_type = node_type['next'].type.pointer()
+
+	# Compute field offsets once, then walk raw addresses
+	next_offset = node_type['next'].bitpos // 8
+	data_offset = node_type['data'].bitpos // 8
+	node_addr = int(node_ptr)
+
 	# Yield nodes, from left to right
-	while node_ptr != 0:
-		node = node_ptr.dereference()
-		node_ptr = node['next']
-		yield node['data']
+	while node_addr != 0:
+		yield gdb.Value(node_addr + data_offset).cast(data_ptr_type).dereference()
+
+		# Read only the next pointer
+		node_addr = int(gdb.Value(node_addr + next_offset).cast(next_ptr_ptr_type).dereference())
 
 def make_tree_iterator(tree: gdb.Value):
 	"""  """
@@ -104,36 +229,7 @@ class OptionalPrinter:
 class ArrayPrinter:
 	"""  """
 
-	class Iterator:
-		"""  """
-
-		def __init__(self, begin: gdb.Value, end: gdb.Value) -> None:
-			"""  """
-
-			self.item = begin
-			self.end = end
-			self.idx = 0
-		
-		def __iter__(self):
-			"""  """
-
-			return self
-		
-		def __next__(self):
-			"""  """
-
-			idx = self.idx
-			self.idx += 1
-
-			# Reached end of array
-			if self.item == self.end:
-				raise StopIteration
-			
-			# Get value and print it
-			value = self.item.dereference()
-			self.item += 1
-
-			return ('[%d]' % idx, value)
+	read_chunk_size = 0x10000
 
 	def __init__(self, typename: str, value: gdb.Value) -> None:
 		"""  """
@@ -142,9 +238,12 @@ class ArrayPrinter:
 		self._value = value
 
 		self.buffer = value['buffer']
-		self.count = value['count']
-		self.capacity = value['capacity']
-		self.is_string = value.type.template_argument(0).code == gdb.TYPE_CODE_CHAR
+		self.count = int(value['count'])
+		self.capacity = int(value['capacity'])
+		self.is_string = is_string_type(value.type)
+
+		if not self.is_string:
+			self._summary_prefix = 'Array %s' % value.type.template_argument(0)
 
 	def display_hint(self) -> str:
 		"""  """
@@ -153,8 +252,52 @@ class ArrayPrinter:
 	
 	def children(self) -> Iterator:
 		"""  """
-		
-		return self.Iterator(self.buffer, self.buffer + self.count)
+
+		item_type = self.buffer.type.target()
+		item_format = get_scalar_format(item_type)
+
+		if item_format is not None:
+			# Read scalar items in bulk rather than one by one
+			yield from self.read_scalars(item_type, item_format)
+			return
+
+		# Walk integer addresses, cast back only to yield.
+		# GDB only pulls as many items as it prints
+		ptr_type = self.buffer.type
+		item_size = item_type.sizeof
+		item_addr = int(self.buffer)
+		end_addr = item_addr + self.count * item_size
+
+		idx = 0
+		while item_addr < end_addr:
+			# Get value and print it
+			yield ('[%d]' % idx, gdb.Value(item_addr).cast(ptr_type).dereference())
+			item_addr += item_size
+			idx += 1
+
+	def read_scalars(self, item_type: gdb.Type, item_format: str) -> Iterator:
+		"""  """
+
+		inferior = gdb.selected_inferior()
+		item_format = get_target_byte_order() + item_format
+		item_size = item_type.sizeof
+		chunk_count = max(1, self.read_chunk_size // item_size)
+
+		# Size first read after what GDB is likely to print
+		hint = get_print_elements_hint()
+		first_chunk_count = chunk_count if hint is None else min(chunk_count, hint)
+
+		buffer_addr = int(self.buffer)
+		idx = 0
+		while idx < self.count:
+			num_items = min(first_chunk_count if idx == 0 else chunk_count, self.count - idx)
+			chunk = inferior.read_memory(buffer_addr + idx * item_size, num_items * item_size)
+
+			for (item,) in struct.iter_unpack(item_format, chunk):
+				# Cast back to item type, so that chars and
+				# sized integers print as they would in memory
+				yield ('[%d]' % idx, gdb.Value(item).cast(item_type))
+				idx += 1
 
 	def to_string(self) -> str:
 		"""  """
@@ -163,7 +306,7 @@ class ArrayPrinter:
 			# TODO
 			return ''
 		else:
-			return 'Array %s[%d] with max. capacity %d' % (self._value.type.template_argument(0), self.count, self.capacity)
+			return '%s[%d] with max. capacity %d' % (self._summary_prefix, self.count, self.capacity)
 
 class StringPrinter:
 	"""  """
@@ -192,63 +335,32 @@ class StringPrinter:
 class ListPrinter:
 	"""  """
 
-	class Iterator:
-		"""  """
-
-		def __init__(self, begin: gdb.Value, end: gdb.Value) -> None:
-			"""  """
-
-			self.item = begin
-			self.end = end
-			self.idx = 0
-		
-		def __iter__(self):
-			"""  """
-
-			return self
-		
-		def __next__(self):
-			"""  """
-
-			idx = self.idx
-			self.idx += 1
-
-			# Check if we reached end
-			if self.item == self.end: raise StopIteration
-			
-			# Get value and increment iterator
-			link = self.item.dereference()
-			self.item = link['next']
-
-			return ('[%d]' % idx, link['data'])
-
 	def __init__(self, typename: str, value: gdb.Value) -> None:
 		"""  """
 
 		self._typename = typename
 		self._value = value
+		self._summary_prefix = 'List %s' % value.type.template_argument(0)
 
 		self.length = value['length']
 		self.head_ptr = value['head']
-		self.tail_ptr = value['tail']
 
 	def display_hint(self) -> str:
 		"""  """
 
 		return 'array'
 	
-	def children(self):
+	def children(self) -> Iterator:
 		"""  """
 
-		if self.head_ptr != 0:
-			return self.Iterator(self.head_ptr, self.tail_ptr.dereference()['next'])
-		else:
-			return []
+		# List is null-terminated, same as tree nodes
+		for idx, item in enumerate(make_node_iterator(self.head_ptr)):
+			yield ('[%d]' % idx, item)
 	
 	def to_string(self) -> str:
 		"""  """
 
-		return 'List %s[%d]' % (self._value.type.template_argument(0), self.length)
+		return '%s[%d]' % (self._summary_prefix, self.length)
 
 class TuplePrinter:
 	"""  """
@@ -258,7 +370,10 @@ class TuplePrinter:
 
 		self._typename = typename
 		self._value = value
-		self._tuple_base = value.type.fields()[0]
+		self._tuple_layout = get_tuple_layout(value.type)
+
+		item_types = [str(item_field.type) for _, item_field, _, _ in self._tuple_layout]
+		self._summary = 'Tuple <%s>[%d]' % (', '.join(item_types), len(item_types))
 
 	def display_hint(self) -> str:
 		"""  """
@@ -267,39 +382,30 @@ class TuplePrinter:
 	
 	def children(self) -> Iterator:
 		"""  """
-		
-		base_type = self._value.type.fields()[0]
-		base = self._value[base_type]
-
-		idx = 0
-		while base is not None:
-			fields = base.type.fields()
-			if len(fields) == 2:
-				# Get item
-				item_type = fields[1]
-				item = base[item_type]
-
-				# Output item
-				yield ('[%d]' % idx, item)
-
-				base_type = fields[0]
-				base = base[base_type]
-				idx += 1
-			else:
-				# Get item
-				item_type = fields[0]
-				item = base[item_type]
 
-				# Output item
-				yield ('[%d]' % idx, item)
-
-				base = None
+		# Only build items from precomputed offsets if the
+		# tuple has not been fetched yet. Fetched values,
+		# e.g. history values or members of a printed struct,
+		# must be read from the bytes already in hand
+		tuple_addr = self._value.address
+		if getattr(self._value, 'is_lazy', False) and tuple_addr is not None:
+			tuple_addr = int(tuple_addr)
+			for idx, (_, _, item_offset, item_ptr_type) in enumerate(self._tuple_layout):
+				yield ('[%d]' % idx, gdb.Value(tuple_addr + item_offset).cast(item_ptr_type).dereference())
+			return
+
+		# Walk cached base fields
+		base = self._value
+		for idx, (base_field, item_field, _, _) in enumerate(self._tuple_layout):
+			base = base[base_field]
+
+			# Output item
+			yield ('[%d]' % idx, base[item_field])
 	
 	def to_string(self) -> str:
 		"""  """
 
-		template_arguments = [str(t) for t in make_template_arguments_iterator(self._value.type)]
-		return 'Tuple <%s>[%d]' % (', '.join(template_arguments), len(template_arguments))
+		return self._summary
 
 class MapPrinter:
 	"""  """
@@ -309,8 +415,7 @@ class MapPrinter:
 
 		self._typename = typename
 		self._value = value
-		self._key_type = value.type.template_argument(0)
-		self._val_type = value.type.template_argument(1)
+		self._summary_prefix = 'Map <%s, %s>' % (value.type.template_argument(0), value.type.template_argument(1))
 		
 		self.tree = value['tree']
 		self.num_items = self.tree['numNodes']
@@ -332,7 +437,7 @@ class MapPrinter:
 	def to_string(self) -> str:
 		"""  """
 
-		return 'Map <%s, %s>[%d]' % (self._key_type, self._val_type, self.num_items)
+		return '%s[%d]' % (self._summary_prefix, self.num_items)
 
 class SetPrinter:
 	"""  """
@@ -342,7 +447,7 @@ class SetPrinter:
 
 		self._typename = typename
 		self._value = value
-		self._item_type = value.type.template_argument(0)
+		self._summary_prefix = 'Set %s' % value.type.template_argument(0)
 
 		self.tree = value['tree']
 		self.size = self.tree['numNodes']
@@ -363,7 +468,7 @@ class SetPrinter:
 	def to_string(self) -> str:
 		"""  """
 
-		return 'Set %s[%d]' % (self._item_type, self.size)
+		return '%s[%d]' % (self._summary_prefix, self.size)
 
 class VecPrinter:
 	"""  """
@@ -373,7 +478,7 @@ class VecPrinter:
 
 		self._typename = typename
 		self._value = value
-		self._vector_type = value.type.template_argument(0)
+		self._vector_type = str(value.type.template_argument(0))
 
 		self.array = value['array']
 		self.size = array_size(self.array)
@@ -392,93 +497,91 @@ class QuatPrinter:
 		self._typename = typename
 		self._value = value
 		
-		try:
-			a = math.acos(value['w'])
-			s = 1.0 / math.sin(a)
-			self.angle = a * 2.0
-			self.axis = [
-				value['x'] * s,
-				value['y'] * s,
-				value['z'] * s
-			]
-		except ZeroDivisionError:
+		# Clamp w to acos domain, normalized quats may exceed it
+		w = max(-1.0, min(1.0, float(value['w'])))
+		s2 = 1.0 - w * w
+
+		if s2 <= 1e-12:
+			# No rotation, axis is undefined
 			self.angle = 0.0
-			self.axis = [0.0, 0.0, 0.0]
+			self.axis = (0.0, 0.0, 0.0)
+		else:
+			s = 1.0 / math.sqrt(s2)
+			self.angle = 2.0 * math.acos(w)
+			self.axis = (
+				float(value['x']) * s,
+				float(value['y']) * s,
+				float(value['z']) * s
+			)
+
+		self._string = 'quat<%g rad around {%g, %g, %g}>' % (self.angle, *self.axis)
 	
 	def to_string(self) -> str:
 		"""  """
 
-		return 'quat<%g rad around {%g, %g, %g}>' % (self.angle, *self.axis)
+		return self._string
 
-class SubPrinter(object):
+class Printer(gdb.printing.RegexpCollectionPrettyPrinter):
 	"""  """
 
-	def __init__(self, name: str, typeprinter) -> None:
-		"""  """
+	reference_type_codes = {gdb.TYPE_CODE_REF}
 
-		self.name = name
-		self.typeprinter = typeprinter
-	
-	def __call__(self, value: gdb.Value):
-		"""  """
+	if hasattr(gdb, 'TYPE_CODE_RVALUE_REF'):
+		reference_type_codes.add(gdb.TYPE_CODE_RVALUE_REF)
 
-		return self.typeprinter(self.name, value)
-
-class Printer(object):
-	"""  """
+	candidate_type_codes = {
+		gdb.TYPE_CODE_STRUCT,
+		gdb.TYPE_CODE_UNION,
+		gdb.TYPE_CODE_TYPEDEF
+	} | reference_type_codes
 
 	def __init__(self, name: str) -> None:
 		"""  """
 
-		super(Printer, self).__init__()
-		self.name = name
-		self.subprinters = []
-		self.lookup_table = {}
-		self.lookup_regex = re.compile('^([\w:]+)(<.*>)?$')
+		super(Printer, self).__init__(name)
+		self.resolve = lru_cache(maxsize=TYPE_CACHE_SIZE)(self.lookup)
 	
-	def add(self, name: str, typeprinter) -> None:
+	def add(self, name: str, regexp: str, typeprinter) -> None:
 		"""  """
 
-		subprinter = SubPrinter(name, typeprinter)
-		self.subprinters.append(subprinter)
-		self.lookup_table[name] = subprinter
-
-	@staticmethod
-	def get_basic_type(type: gdb.Type):
+		self.add_printer(name, regexp, partial(typeprinter, name))
+		self.resolve.cache_clear()
+	
+	def lookup(self, typename: str):
 		"""  """
 
-		if type.code == gdb.TYPE_CODE_REF:
-			# Dereference type
-			type = type.target()
-		
-		# Get unqualified type, strip typedefs
-		type = type.unqualified().strip_typedefs()
+		# Match against subprinters regexps
+		for subprinter in self.subprinters:
+			if subprinter.compiled_re.search(typename):
+				return subprinter
 
-		return type.tag
+		return None
 	
 	def __call__(self, value: gdb.Value):
 		"""  """
 
-		# Get basic typename
-		typename = self.get_basic_type(value.type)
-		if typename is None: return None
-
-		# Match against lookup regex
-		match = self.lookup_regex.match(typename)
-		if match is None: return None
+		# Only structs, possibly behind references
+		# or typedefs, can be korin types
+		if value.type.code not in self.candidate_type_codes: return None
 
-		if value.type.code == gdb.TYPE_CODE_REF:
+		# Strip typedefs, then dereference references
+		type = value.type.strip_typedefs()
+		if type.code in self.reference_type_codes:
 			if hasattr(gdb.Value, 'referenced_value'):
 				value = value.referenced_value()
+			else:
+				value = value.cast(type.target())
 
-		# Match against lookup table
-		try:
-			basename = match.group(1)
-			subprinter = self.lookup_table[basename]
-			return subprinter(value)
-		except KeyError:
-			# Printer not found, return None
-			return None
+			type = value.type.strip_typedefs()
+
+		typename = type.tag
+		if typename is None: return None
+
+		# Resolve subprinter, cached per typename
+		subprinter = self.resolve(typename)
+		if subprinter is None or not subprinter.enabled: return None
+
+		return subprinter.gen_printer(value)
 
 korin_printer = None
 
@@ -488,25 +591,25 @@ def build_korin_printer() -> None:
 	global korin_printer
 
 	korin_printer = Printer('korin')
-	korin_printer.add('Atomic', AtomicPrinter)
-	korin_printer.add('Optional', OptionalPrinter)
-	korin_printer.add('Array', ArrayPrinter)
-	korin_printer.add('StringBase', StringPrinter)
-	korin_printer.add('List', ListPrinter)
-	korin_printer.add('Tuple', TuplePrinter)
-	korin_printer.add('Map', MapPrinter)
-	korin_printer.add('Set', SetPrinter)
-	korin_printer.add('Vec2', VecPrinter)
-	korin_printer.add('Vec3', VecPrinter)
-	korin_printer.add('Vec4', VecPrinter)
-	korin_printer.add('Quat', QuatPrinter)
+	korin_printer.add('Atomic', '^Atomic<.*>$', AtomicPrinter)
+	korin_printer.add('Optional', '^Optional<.*>$', OptionalPrinter)
+	korin_printer.add('Array', '^Array<.*>$', ArrayPrinter)
+	korin_printer.add('StringBase', '^StringBase<.*>$', StringPrinter)
+	korin_printer.add('List', '^List<.*>$', ListPrinter)
+	korin_printer.add('Tuple', '^Tuple<.*>$', TuplePrinter)
+	korin_printer.add('Map', '^Map<.*>$', MapPrinter)
+	korin_printer.add('Set', '^Set<.*>$', SetPrinter)
+	korin_printer.add('Vec2', '^Vec2<.*>$', VecPrinter)
+	korin_printer.add('Vec3', '^Vec3<.*>$', VecPrinter)
+	korin_printer.add('Vec4', '^Vec4<.*>$', VecPrinter)
+	korin_printer.add('Quat', '^Quat$', QuatPrinter)
 
 def register_korin_printer(obj: gdb.Objfile) -> None:
 	"""  """
 
 	global korin_printer
 
-	obj.pretty_printers.append(korin_printer)
+	gdb.printing.register_pretty_printer(obj, korin_printer, replace=True)
 
 build_korin_printer()
 register_korin_printer(gdb.current_objfile())